@@ -0,0 +1,94 @@
+"""pickup_bag_cycle state machine: picked -> inbound -> sorting -> completed.
+
+Every transition is one guarded UPDATE (... WHERE id = %s AND status IN (states
+it may leave)), so it needs no read first and two scanners cannot both take it;
+the row count alone says whether it happened. A transition back into the same
+state (reweigh_inbound) always moves its timestamp forward, so a repeat within
+the same second still changes the row and is counted.
+
+Plain tables and SQL builders only; app.py registers the statements and runs
+them (transition_cycle_flow, weigh_inbound_flow).
+"""
+
+CYCLE_STATES = ("picked", "inbound", "sorting", "completed")
+CYCLE_STATE_TIMESTAMPS = {
+    "picked": "picked_at",
+    "inbound": "inbound_at",
+    "sorting": "sorted_at",
+    "completed": "completed_at",
+}
+# Transition -> (target state, states it may be taken from)
+CYCLE_TRANSITIONS = {
+    "picked": ("picked", ()),  # Only on insert (cycle.insert_picked)
+    "inbound": ("inbound", ("picked",)),
+    "sorting": ("sorting", ("picked", "inbound")),
+    "completed": ("completed", ("picked", "inbound", "sorting")),
+    "reweigh_inbound": ("inbound", ("inbound",)),  # Scan-weight on a bag already inbound
+}
+# Scan-weight takes whichever of these the cycle's status allows
+WEIGH_INBOUND_TRANSITIONS = ("inbound", "reweigh_inbound")
+
+
+def status_list(statuses):
+    return ", ".join(f"'{status}'" for status in statuses)
+
+
+def timestamp_sql(name):
+    """SET expression for the target state's timestamp of transition `name`"""
+    to_status, from_statuses = CYCLE_TRANSITIONS[name]
+    column = CYCLE_STATE_TIMESTAMPS[to_status]
+    if to_status in from_statuses:
+        # Otherwise MySQL reports a same-second repeat as 0 rows
+        return f"{column} = IF({column} >= NOW(), {column} + INTERVAL 1 SECOND, NOW())"
+    return f"{column} = NOW()"
+
+
+def transition_sql(name, weighed):
+    """UPDATE taking transition `name` on one cycle; params ([inbound_weight,] id)"""
+    to_status, from_statuses = CYCLE_TRANSITIONS[name]
+    weight = "inbound_weight = %s, " if weighed else ""
+    return (
+        f"UPDATE pickup_bag_cycle SET {weight}status = '{to_status}', {timestamp_sql(name)} "
+        f"WHERE id = %s AND status IN ({status_list(from_statuses)})"
+    )
+
+
+def record_inbound_many_sql(name, count):
+    """Weighed transition `name` for `count` cycles; params (id, weight) pairs then the ids.
+    Its guard leaves alone a cycle moved on since it was read."""
+    to_status, from_statuses = CYCLE_TRANSITIONS[name]
+    return (
+        "UPDATE pickup_bag_cycle SET inbound_weight = CASE id "
+        + " ".join(["WHEN %s THEN %s"] * count)
+        + f" END, status = '{to_status}', {timestamp_sql(name)} "
+        f"WHERE id IN ({', '.join(['%s'] * count)}) AND status IN ({status_list(from_statuses)})"
+    )
+
+
+def transition_statements():
+    """(transition, sets inbound_weight) pairs that have an UPDATE; "picked" is insert-only"""
+    return [
+        (name, weighed)
+        for name, (to_status, from_statuses) in CYCLE_TRANSITIONS.items() if from_statuses
+        for weighed in ((False, True) if to_status == "inbound" else (False,))
+    ]
+
+
+def enters_new_state(name):
+    """True when transition `name` moves a cycle into another state (rolled up
+    for turnaround), False for a repeat of the state it is in"""
+    to_status, from_statuses = CYCLE_TRANSITIONS[name]
+    return to_status not in from_statuses
+
+
+def cycle_transition_allowed(current_status, name):
+    return current_status in CYCLE_TRANSITIONS[name][1]
+
+
+def weigh_inbound_allowed(current_status):
+    return any(cycle_transition_allowed(current_status, name) for name in WEIGH_INBOUND_TRANSITIONS)
+
+
+def weigh_inbound_order(current_status):
+    """Scan-weight transitions to try, the one current_status allows first"""
+    return sorted(WEIGH_INBOUND_TRANSITIONS, key=lambda name: not cycle_transition_allowed(current_status, name))
@@ -0,0 +1,213 @@
+"""Versioned, idempotent schema changes, applied with `flask db-migrate`.
+
+Applied versions are recorded in schema_migrations. Index requirements are
+re-verified on every run: a requirement is met by any index whose leading
+columns match (or a unique index covering a prefix of them), so existing
+indexes are reused instead of duplicated.
+
+Everything here works on a DB-API cursor returning dict rows; app.py holds the
+list of migrations (their probes are its registered statements) and the
+connection handling.
+"""
+from collections import namedtuple
+
+# probe: SQL (or anything with a .sql attribute) EXPLAINed before and after the index is added
+IndexSpec = namedtuple("IndexSpec", ["table", "name", "columns", "probe", "probe_params"])
+# statements: SQL strings, or callables(cursor) returning the SQL still needed
+Migration = namedtuple("Migration", ["version", "name", "indexes", "statements"])
+
+_KEY_TABLES = ("b2b_segregation", "b2b_impact", "branch_pickup_frequency", "b2b_corporate_branch_master")
+_KEY_COLLATION = "utf8mb4_unicode_ci"
+
+
+def varchar_corporate_code(cursor):
+    """corporate_code is compared as a string everywhere; store it as one"""
+    cursor.execute(
+        """
+        SELECT TABLE_NAME AS table_name, DATA_TYPE AS data_type, IS_NULLABLE AS nullable, COLUMN_DEFAULT AS col_default
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME = 'corporate_code'
+            AND TABLE_NAME IN (%s, %s, %s, %s)
+        """,
+        _KEY_TABLES,
+    )
+    statements = []
+    for row in cursor.fetchall():
+        if row["data_type"].lower() in ("varchar", "char"):
+            continue
+        default = f" DEFAULT '{row['col_default']}'" if row["col_default"] is not None else ""
+        statements.append(
+            f"ALTER TABLE {row['table_name']} MODIFY corporate_code VARCHAR(64) "
+            f"CHARACTER SET utf8mb4 COLLATE {_KEY_COLLATION} "
+            f"{'NULL' if row['nullable'] == 'YES' else 'NOT NULL'}{default}"
+        )
+    return statements
+
+
+def unify_key_collation(cursor):
+    """Convert tables whose text columns use another collation, so joins and
+    lookups on branch_code no longer need COLLATE on the column side"""
+    cursor.execute(
+        """
+        SELECT DISTINCT TABLE_NAME AS table_name
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s, %s, %s, %s)
+            AND COLLATION_NAME IS NOT NULL AND COLLATION_NAME <> %s
+        """,
+        _KEY_TABLES + (_KEY_COLLATION,),
+    )
+    return [
+        f"ALTER TABLE {row['table_name']} CONVERT TO CHARACTER SET utf8mb4 COLLATE {_KEY_COLLATION}"
+        for row in cursor.fetchall()
+    ]
+
+
+def dedupe_barcode_master(cursor):
+    """One row per barcode_id before it becomes unique: keep the active row
+    (lowest id), else the first row, and drop the duplicates left by racing
+    auto-registrations. Cycles reference barcode_id, not the row id."""
+    if table_indexes(cursor, "barcode_master_table") is None:
+        return []
+    cursor.execute(
+        """
+        SELECT b.id
+        FROM barcode_master_table b
+        JOIN (
+            SELECT barcode_id, MIN(CASE WHEN is_active = 1 THEN id END) AS active_id, MIN(id) AS first_id
+            FROM barcode_master_table
+            GROUP BY barcode_id
+            HAVING COUNT(*) > 1
+        ) dup ON dup.barcode_id = b.barcode_id
+        WHERE b.id <> COALESCE(dup.active_id, dup.first_id)
+        """
+    )
+    ids = [str(row["id"]) for row in cursor.fetchall()]
+    return [
+        f"DELETE FROM barcode_master_table WHERE id IN ({', '.join(ids[start:start + 1000])})"
+        for start in range(0, len(ids), 1000)
+    ]
+
+
+def unique_barcode_id(cursor):
+    indexes = table_indexes(cursor, "barcode_master_table")
+    if indexes is None or any(unique and columns == ["barcode_id"] for unique, columns in indexes.values()):
+        return []
+    return [
+        "ALTER TABLE barcode_master_table ADD UNIQUE KEY uq_barcode_master_barcode_id (barcode_id), "
+        "ALGORITHM=INPLACE, LOCK=NONE"
+    ]
+
+
+def table_indexes(cursor, table):
+    """{index name: (unique, [columns in order])} or None if the table does not exist"""
+    cursor.execute(
+        "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,),
+    )
+    if not cursor.fetchone()["n"]:
+        return None
+    cursor.execute(
+        """
+        SELECT INDEX_NAME AS index_name, NON_UNIQUE AS non_unique, COLUMN_NAME AS column_name
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX
+        """,
+        (table,),
+    )
+    indexes = {}
+    for row in cursor.fetchall():
+        unique, columns = indexes.setdefault(row["index_name"], (not int(row["non_unique"]), []))
+        columns.append(row["column_name"].lower())
+    return indexes
+
+
+def index_satisfying(indexes, columns):
+    """Name of an existing index that serves lookups on `columns`, or None"""
+    wanted = [c.lower() for c in columns]
+    for name, (unique, existing) in indexes.items():
+        if existing[: len(wanted)] == wanted:
+            return name
+        if unique and wanted[: len(existing)] == existing:
+            return name
+    return None
+
+
+def explain(cursor, probe, params):
+    cursor.execute("EXPLAIN " + getattr(probe, "sql", probe), params)
+    return [
+        f"{row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} extra={row.get('Extra')}"
+        for row in cursor.fetchall()
+    ]
+
+
+def apply_migrations(cursor, migrations, dry_run=True, echo=print):
+    """Apply pending `migrations` and verify all index requirements.
+    With dry_run nothing is changed: the current EXPLAIN plans and the DDL
+    that would run are reported instead. Returns True when the schema is
+    (or, for a dry run, would be) up to date; driver errors propagate."""
+    cursor.execute(
+        "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'schema_migrations'"
+    )
+    applied = set()
+    if cursor.fetchone()["n"]:
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row["version"] for row in cursor.fetchall()}
+    elif not dry_run:
+        cursor.execute(
+            """
+            CREATE TABLE schema_migrations (
+                version INT NOT NULL PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at DATETIME NOT NULL
+            )
+            """
+        )
+
+    ok = True
+    for migration in migrations:
+        state = "applied" if migration.version in applied else "pending"
+        echo(f"== {migration.version:04d} {migration.name} ({state})")
+        migration_ok = True
+        if migration.version not in applied:
+            for statement in migration.statements:
+                # Callables inspect the live schema and return only the DDL/DML still needed
+                for sql in (statement(cursor) if callable(statement) else [statement]):
+                    echo(f"  {'would run' if dry_run else 'running'}: {' '.join(sql.split())[:200]}")
+                    if not dry_run:
+                        cursor.execute(sql)
+        for spec in migration.indexes:
+            indexes = table_indexes(cursor, spec.table)
+            if indexes is None:
+                echo(f"  ! {spec.table}: table does not exist, skipped")
+                migration_ok = False
+                continue
+            existing = index_satisfying(indexes, spec.columns)
+            if existing:
+                echo(f"  ok {spec.table}({', '.join(spec.columns)}) served by {existing}")
+                continue
+            if spec.name in indexes:
+                echo(f"  ! {spec.table}.{spec.name} exists on ({', '.join(indexes[spec.name][1])}), "
+                     f"expected ({', '.join(spec.columns)}); fix it by hand")
+                migration_ok = False
+                continue
+            ddl = (
+                f"ALTER TABLE {spec.table} ADD INDEX {spec.name} ({', '.join(spec.columns)}), "
+                "ALGORITHM=INPLACE, LOCK=NONE"
+            )
+            for line in explain(cursor, spec.probe, spec.probe_params):
+                echo(f"  before  {line}")
+            echo(f"  {'would run' if dry_run else 'running'}: {ddl}")
+            if dry_run:
+                continue
+            cursor.execute(ddl)
+            for line in explain(cursor, spec.probe, spec.probe_params):
+                echo(f"  after   {line}")
+        if migration.version not in applied and not dry_run and migration_ok:
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, NOW())",
+                (migration.version, migration.name),
+            )
+            applied.add(migration.version)
+        ok = ok and migration_ok
+    return ok
@@ -0,0 +1,93 @@
+"""Shared fixtures.
+
+Most tests need no database: handler flows are driven with drive_flow() and
+views run against FakeServer, which stands in for the MySQL driver. Tests
+marked `mysql` use real servers named by TEST_MYSQL_HOST (and, for replica
+routing, TEST_MYSQL_REPLICA_HOST) and are skipped when those are not set:
+
+    TEST_MYSQL_HOST=127.0.0.1 TEST_MYSQL_USER=root TEST_MYSQL_PASSWORD=... \\
+    TEST_MYSQL_DB=inventory_test python -m pytest backend/tests
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+from fakes import FakeServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# No loader thread hitting the (fake) database between statements
+os.environ.setdefault("BARCODE_INDEX_ENABLED", "0")
+# Log to the console only, not into an app.log in the working tree
+os.environ.setdefault("LOG_FILE", "")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "mysql: needs a MySQL server (TEST_MYSQL_HOST)")
+
+
+def _import_backend():
+    try:
+        importlib.import_module("modelApplicationPath")
+    except ImportError:
+        # Shipped as ModelApplicationPath.py on some (case-insensitive) deployments
+        try:
+            sys.modules["modelApplicationPath"] = importlib.import_module("ModelApplicationPath")
+        except ImportError:
+            pass
+    return importlib.import_module("app")
+
+
+@pytest.fixture(scope="session")
+def backend():
+    """The app module (backend/app.py)"""
+    try:
+        return _import_backend()
+    except ImportError as e:
+        pytest.skip(f"backend app not importable: {e}")
+
+
+@pytest.fixture
+def fake_db(backend, monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(backend.mysql.connector, "connect", server.connect)
+    backend._reset_db_pools_after_fork()
+    yield server
+    backend._reset_db_pools_after_fork()
+
+
+@pytest.fixture
+def client(backend, fake_db, monkeypatch):
+    monkeypatch.setattr(backend.app, "testing", True)
+    return backend.app.test_client()
+
+
+PREFIX = "/aiml/corporatewebsite"
+
+
+def _mysql_settings(host_variable):
+    host = os.getenv(host_variable)
+    if not host:
+        pytest.skip(f"{host_variable} is not set")
+    return {
+        "MYSQL_HOST": host,
+        "MYSQL_PORT": int(os.getenv(host_variable.replace("HOST", "PORT"), 3306)),
+        "MYSQL_USER": os.getenv("TEST_MYSQL_USER", "root"),
+        "MYSQL_PASSWORD": os.getenv("TEST_MYSQL_PASSWORD", ""),
+        "MYSQL_DB": os.getenv("TEST_MYSQL_DB", "inventory_test"),
+    }
+
+
+@pytest.fixture
+def mysql_app(backend, monkeypatch):
+    """The app pointed at the TEST_MYSQL_* server, with a fresh pool"""
+    for key, value in _mysql_settings("TEST_MYSQL_HOST").items():
+        monkeypatch.setitem(backend.app.config, key, value)
+    monkeypatch.setitem(backend.app.config, "MYSQL_REPLICA_HOSTS", [])
+    monkeypatch.setattr(backend.app, "testing", True)
+    backend._reset_db_pools_after_fork()
+    yield backend.app
+    backend._reset_db_pools_after_fork()
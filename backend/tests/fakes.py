@@ -0,0 +1,138 @@
+"""Test doubles: a scripted stand-in for the MySQL driver and a flow runner
+that answers each DbQuery from a function instead of a database."""
+import itertools
+
+
+def normalize(sql):
+    return " ".join(sql.split())
+
+
+class FakeCursor:
+    def __init__(self, server):
+        self.server = server
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, sql, params=None, multi=False):
+        sql = normalize(sql)
+        self.server.log.append((sql, params))
+        reply = self.server.respond(sql, params)
+        if isinstance(reply, Exception):
+            raise reply
+        reply = reply or {}
+        self.rows = list(reply.get("rows", []))
+        self.rowcount = reply.get("rowcount", len(self.rows) if self.rows else 1)
+        self.lastrowid = reply.get("lastrowid", next(self.server.ids))
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        self.server.log.append((normalize(sql), seq_params))
+        reply = self.server.respond(normalize(sql), seq_params) or {}
+        if isinstance(reply, Exception):
+            raise reply
+        self.rowcount = reply.get("rowcount", len(seq_params))
+        self.lastrowid = next(self.server.ids)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+    @property
+    def description(self):
+        return [(name,) for name in (self.rows[0] if self.rows else {})]
+
+    @property
+    def column_names(self):
+        return tuple(name for name, in self.description)
+
+
+class FakeConnection:
+    def __init__(self, server):
+        self.server = server
+        self.in_transaction = False
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self.server)
+
+    def start_transaction(self, **kwargs):
+        self.server.log.append(("START TRANSACTION", None))
+        self.in_transaction = True
+
+    def commit(self):
+        self.server.log.append(("COMMIT", None))
+        self.in_transaction = False
+
+    def rollback(self):
+        self.server.log.append(("ROLLBACK", None))
+        self.in_transaction = False
+
+    def cmd_query(self, sql):
+        self.server.log.append((sql, None))
+
+    def ping(self, reconnect=False):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class FakeServer:
+    """Answers statements with responder(sql, params) -> {"rows", "rowcount",
+    "lastrowid"} (all optional), None or an exception to raise"""
+
+    def __init__(self):
+        self.log = []
+        self.responder = None
+        self.ids = itertools.count(100)
+
+    def respond(self, sql, params):
+        return self.responder(sql, params) if self.responder else None
+
+    def connect(self, **kwargs):
+        return FakeConnection(self)
+
+    def statements(self, prefix=""):
+        """Logged SQL (without transaction control and session SETs) starting with prefix"""
+        return [
+            sql for sql, _ in self.log
+            if sql.startswith(prefix) and not sql.startswith(("SET ", "START", "COMMIT", "ROLLBACK", "SAVEPOINT"))
+        ]
+
+
+def drive_flow(backend, flow, answer, ops=None):
+    """Run a handler flow without a database: answer(sql, params, fetch) gives
+    each DbQuery's execute_query-style result. Returns (flow result, [(sql, params)]);
+    every operation yielded is also appended to `ops` if given."""
+    queries = []
+    result = None
+    while True:
+        try:
+            op = flow.send(result)
+        except StopIteration as done:
+            return done.value, queries
+        if ops is not None:
+            ops.append(op)
+        if isinstance(op, backend.DbQuery):
+            sql = op.statement.sql if isinstance(op.statement, backend.SqlStatement) else op.statement
+            queries.append((normalize(sql), op.params))
+            result = answer(normalize(sql), op.params, op.fetch)
+        elif isinstance(op, backend.DbSavepoint):
+            result = "sp"
+        elif isinstance(op, backend.DbTxState):
+            result = {"failed": False, "error": None}
+        else:
+            result = None
@@ -0,0 +1,77 @@
+"""CSV barcode import: row parsing, classification against the database, chunk commits."""
+import io
+import re
+from datetime import datetime
+
+import pytest
+from mysql.connector import Error
+
+
+def read(backend, text, bagtype="B2B", is_active=1):
+    return list(backend._read_import_csv(io.StringIO(text), bagtype, is_active))
+
+
+def test_read_uses_defaults_and_per_row_overrides(backend):
+    rows = read(backend, "Barcode_ID , bagtype,is_active\nA1,,\nA2,B2C,false\n,,1\nA3,,yes\n\n")
+    assert rows == [
+        (2, "A1", "B2B", 1, None),
+        (3, "A2", "B2C", 0, None),
+        (4, None, None, None, "barcode_id is required"),
+        (5, "A3", None, None, "is_active must be 0 or 1"),
+    ]
+
+
+@pytest.mark.parametrize("text, message", [("", "CSV file is empty"), ("id,bagtype\n1,B2B\n", "barcode_id column")])
+def test_read_rejects_unusable_header(backend, text, message):
+    with pytest.raises(ValueError, match=message):
+        read(backend, text)
+
+
+def test_classify_against_database_rows(backend):
+    created_at = datetime(2026, 10, 1)
+    known = {
+        "on1": {"id": 1, "barcode_id": "ON1", "is_active": 1},
+        "off1": {"id": 2, "barcode_id": "OFF1", "is_active": 0},
+    }
+    chunk = [(2, "on1 ", "B2B", 1), (3, "OFF1", "B2B", 1), (4, "NEW1", "B2C", 0)]
+    new_rows, changed, unchanged = backend.classify_import_chunk(chunk, known, created_at)
+    assert new_rows == [("NEW1", "B2C", 0, created_at)]
+    assert changed == [{"id": 2, "barcode_id": "OFF1", "is_active": 1}]
+    assert unchanged == 1
+
+
+def import_csv(backend, text, **kwargs):
+    with backend.app.test_request_context():
+        return backend.import_barcodes(io.StringIO(text), **kwargs)
+
+
+def test_dry_run_writes_nothing(backend, fake_db):
+    fake_db.responder = lambda sql, params: {"rows": []} if sql.startswith("SELECT") else None
+    summary = import_csv(backend, "barcode_id\nA1\na1\nA2\n", dry_run=True)
+    assert (summary["inserted"], summary["duplicates"]) == (2, 1)
+    assert fake_db.statements("INSERT") == [] and fake_db.statements("UPDATE") == []
+
+
+def test_failed_chunk_is_not_counted_and_stops(backend, fake_db, monkeypatch):
+    monkeypatch.setitem(backend.app.config, "BARCODE_IMPORT_CHUNK", 2)
+
+    def responder(sql, params):
+        if sql.startswith("SELECT"):
+            return {"rows": []}
+        if sql.startswith("INSERT") and params[0][0] == "A3":
+            return Error("Deadlock found")
+        return None
+
+    fake_db.responder = responder
+    summary = import_csv(backend, "barcode_id\nA1\nA2\nA3\nA4\nA5\n")
+    assert summary["inserted"] == 2
+    assert summary["failed"] == 2
+    assert summary["stopped"].startswith("Database error importing lines 4-5")
+    assert summary["rows"] == 4  # A5 was never read
+
+
+def test_upserts_use_the_row_alias(backend):
+    """One upsert idiom (MySQL 8.0.19+ `AS new`), never the deprecated VALUES()"""
+    assert "AS new" in backend.SQL_BARCODE_IMPORT_UPSERT.sql
+    for statement in backend.SQL_STATEMENTS.values():
+        assert not re.search(r"UPDATE .*\bVALUES\s*\(", statement.sql), statement.name
@@ -0,0 +1,96 @@
+"""Scans never reactivate a deactivated barcode, and only missing ids are registered."""
+from fakes import drive_flow
+
+
+class MasterTable:
+    """barcode_master_table for drive_flow(): rows by barcode_id"""
+
+    def __init__(self, *rows):
+        self.rows = {row["barcode_id"]: dict(row) for row in rows}
+        self.writes = []
+
+    def __call__(self, sql, params, fetch):
+        if sql.startswith("SELECT COUNT(*) AS n FROM ("):  # unique key check
+            return {"success": True, "data": {"n": 1}}
+        if sql.startswith("INSERT"):
+            self.writes.append(sql)
+            if "VALUES (%s, %s, %s, %s)" in sql:  # insert_or_get
+                barcode_id = params[0]
+                if barcode_id in self.rows:
+                    return {"success": True, "data": {"lastrowid": self.rows[barcode_id]["id"], "rowcount": 0}}
+                self.rows[barcode_id] = {"id": 50, "barcode_id": barcode_id, "bagtype": params[1],
+                                         "is_active": params[2], "created_at": params[3]}
+                return {"success": True, "data": {"lastrowid": 50, "rowcount": 1}}
+            for barcode_id, bagtype in zip(params[::2], params[1::2]):
+                self.rows.setdefault(barcode_id, {"id": 60 + len(self.rows), "barcode_id": barcode_id,
+                                                  "bagtype": bagtype, "is_active": 1, "created_at": None})
+            return {"success": True, "data": len(params) // 2}
+        if sql.startswith("SELECT") and "barcode_master_table" in sql:
+            if "WHERE id = %s" in sql:
+                rows = [row for row in self.rows.values() if row["id"] == params[0]]
+            else:
+                rows = [self.rows[barcode_id] for barcode_id in params if barcode_id in self.rows]
+            return {"success": True, "data": rows if fetch == "all" else (rows[0] if rows else None)}
+        return {"success": True, "data": None}
+
+
+def test_scan_of_deactivated_barcode_is_inactive(backend):
+    table = MasterTable({"id": 1, "barcode_id": "OLD1", "bagtype": "B2B", "is_active": 0, "created_at": None})
+    (body, status), _ = drive_flow(backend, backend.scan_barcode_flow({"barcode_id": "OLD1"}), table)
+    assert (status, body["status"]) == (403, "inactive")
+    assert table.writes == [] and table.rows["OLD1"]["is_active"] == 0
+
+
+def test_scan_registers_unknown_barcode(backend):
+    table = MasterTable()
+    (body, status), _ = drive_flow(backend, backend.scan_barcode_flow({"barcode_id": "NEW1"}), table)
+    assert (status, body["data"]["is_active"]) == (200, 1)
+    assert len(table.writes) == 1 and "is_active = 1" not in table.writes[0]
+
+
+def test_scan_of_existing_barcode_does_not_write(backend):
+    table = MasterTable({"id": 2, "barcode_id": "ON1", "bagtype": "B2B", "is_active": 1, "created_at": None})
+    (body, status), _ = drive_flow(backend, backend.scan_barcode_flow({"barcode_id": "ON1"}), table)
+    assert status == 200 and table.writes == []
+
+
+def test_ensure_barcode_leaves_existing_rows_alone(backend):
+    table = MasterTable({"id": 3, "barcode_id": "OFF", "bagtype": "B2B", "is_active": 0, "created_at": None})
+    result, _ = drive_flow(backend, backend.ensure_barcode_flow("OFF"), table)
+    assert result["created"] is False and result["data"]["is_active"] == 0
+
+
+def test_batch_scan_reports_inactive(backend):
+    table = MasterTable(
+        {"id": 4, "barcode_id": "OFF", "bagtype": "B2B", "is_active": 0, "created_at": None},
+        {"id": 5, "barcode_id": "ON", "bagtype": "B2B", "is_active": 1, "created_at": None},
+    )
+    (body, status), _ = drive_flow(
+        backend, backend.scan_barcode_batch_flow({"barcode_ids": ["OFF", "ON", "NEW"]}), table
+    )
+    assert status == 200
+    assert [r["status"] for r in body["data"]["results"]] == ["inactive", "found", "registered"]
+    assert table.rows["OFF"]["is_active"] == 0
+    assert "ON DUPLICATE KEY UPDATE id = id" in table.writes[0]
+
+
+def test_check_then_insert_until_unique_key_exists(backend):
+    table = MasterTable()
+    unique_key = table.__call__
+
+    def answer(sql, params, fetch):
+        if sql.startswith("SELECT COUNT(*) AS n FROM ("):
+            return {"success": True, "data": {"n": 0}}
+        if sql.startswith("INSERT"):
+            table.rows[params[0]] = {"id": 70, "barcode_id": params[0], "bagtype": params[1],
+                                     "is_active": params[2], "created_at": None}
+            return {"success": True, "data": 70}
+        return unique_key(sql, params, fetch)
+
+    backend._barcode_unique_key.reset()
+    try:
+        result, queries = drive_flow(backend, backend.ensure_barcode_flow("PRE1"), answer)
+        assert result["created"] and result["data"]["id"] == 70
+        assert [sql.split()[0] for sql, _ in queries] == ["SELECT", "SELECT", "INSERT", "SELECT"]
+    finally:
+        backend._barcode_unique_key.reset()
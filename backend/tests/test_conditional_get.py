@@ -0,0 +1,39 @@
+"""ETags, If-None-Match and response compression."""
+import gzip
+
+from conftest import PREFIX
+
+
+def test_requested_etags_strip_our_codings(backend):
+    assert backend.requested_etags(None) == frozenset()
+    assert backend.requested_etags('"abc-gzip", W/"def", "ghi"') == {"abc", "def", "ghi"}
+    assert backend.requested_etags("*") == {"*"}
+
+
+def test_conditional_json(backend):
+    with backend.app.test_request_context(headers={"If-None-Match": '"v1"'}):
+        response = backend.conditional_json("v1", {"a": 1})
+        assert response.status_code == 304 and response.get_data() == b""
+        assert response.headers["ETag"] == '"v1"'
+        response = backend.conditional_json("v2", {"a": 1}, status=201)
+        assert response.status_code == 201 and response.get_json() == {"a": 1}
+        assert response.headers["Cache-Control"] == "no-cache"
+
+
+def test_compressed_etag_revalidates(backend, client, fake_db, monkeypatch):
+    monkeypatch.setitem(backend.app.config, "RESPONSE_COMPRESS_MIN_BYTES", 10)
+    fake_db.responder = lambda sql, params: (
+        {"rows": [{"id": 7, "barcode_id": "BC7", "status": "picked", "barcode_info_id": None}]}
+        if sql.startswith("SELECT") else None
+    )
+    url = f"{PREFIX}/barcode/cycle/7"
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"BC7" in gzip.decompress(response.get_data())
+    etag = response.headers["ETag"]
+    assert etag.endswith('-gzip"')
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+    response = client.get(url, headers={"If-None-Match": etag})  # Same version, other coding
+    assert response.status_code == 304
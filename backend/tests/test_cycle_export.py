@@ -0,0 +1,57 @@
+"""Streamed cycle export: the connection goes back to the pool however the response ends."""
+from datetime import datetime
+
+from conftest import PREFIX
+
+URL = f"{PREFIX}/barcode/cycle/export"
+COLUMNS = ("id", "cycle_id", "barcode_id", "branch_code", "pickup_weight", "inbound_weight", "status",
+           "picked_at", "inbound_at", "sorted_at", "completed_at", "created_at")
+
+
+def in_use(backend):
+    return backend.get_db_pool_stats()["primary"]["in_use"]
+
+
+def cycles(sql, params):
+    if sql.startswith("SELECT id, cycle_id"):
+        return {"rows": [
+            dict(dict.fromkeys(COLUMNS), id=row_id, cycle_id=f"C{row_id}", status="picked",
+                 created_at=datetime(2026, 10, 1))
+            for row_id in range(1, 6)
+        ]}
+    return None
+
+
+def test_head_releases_the_connection(backend, client, fake_db):
+    fake_db.responder = cycles
+    for _ in range(3):
+        with client.head(URL) as response:  # Closed as a WSGI server would
+            assert response.status_code == 200
+    assert in_use(backend) == 0
+
+
+def test_unread_body_releases_the_connection(backend, client, fake_db):
+    fake_db.responder = cycles
+    response = client.get(URL, buffered=False)
+    assert in_use(backend) == 1
+    response.close()
+    assert in_use(backend) == 0
+
+
+def test_full_export(backend, client, fake_db, monkeypatch):
+    monkeypatch.setitem(backend.app.config, "CYCLE_EXPORT_FETCH_SIZE", 2)
+    fake_db.responder = cycles
+    response = client.get(f"{URL}?format=csv")
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0].startswith("id,cycle_id") and len(lines) == 6
+    assert in_use(backend) == 0
+
+
+def test_stream_closed_before_reading_releases(backend, fake_db):
+    fake_db.responder = cycles
+    with backend.app.test_request_context():
+        result = backend.stream_query(f"SELECT {backend.CYCLE_LIST_COLUMNS} FROM pickup_bag_cycle")
+        assert in_use(backend) == 1
+        result["data"].close()
+        assert in_use(backend) == 0
+        result["data"].close()  # Idempotent
@@ -0,0 +1,126 @@
+"""Cycle state machine: the tables in cycle_states.py and the flows app.py runs them with."""
+import pytest
+
+import cycle_states
+from fakes import drive_flow
+
+
+@pytest.mark.parametrize("current, name, allowed", [
+    ("picked", "inbound", True),
+    ("inbound", "inbound", False),
+    ("inbound", "reweigh_inbound", True),
+    ("picked", "reweigh_inbound", False),
+    ("inbound", "sorting", True),
+    ("completed", "sorting", False),
+    ("sorting", "completed", True),
+    ("completed", "completed", False),
+    (None, "inbound", False),
+    ("picked", "picked", False),  # Insert-only
+])
+def test_transition_allowed(current, name, allowed):
+    assert cycle_states.cycle_transition_allowed(current, name) is allowed
+
+
+def test_weigh_inbound_order():
+    assert cycle_states.weigh_inbound_order("picked") == ["inbound", "reweigh_inbound"]
+    assert cycle_states.weigh_inbound_order("inbound") == ["reweigh_inbound", "inbound"]
+    assert not cycle_states.weigh_inbound_allowed("sorting")
+
+
+def test_transition_sql_guards_on_from_states():
+    sql = cycle_states.transition_sql("sorting", False)
+    assert sql == (
+        "UPDATE pickup_bag_cycle SET status = 'sorting', sorted_at = NOW() "
+        "WHERE id = %s AND status IN ('picked', 'inbound')"
+    )
+    assert cycle_states.transition_sql("inbound", True).startswith(
+        "UPDATE pickup_bag_cycle SET inbound_weight = %s, status = 'inbound'"
+    )
+
+
+def test_self_loop_always_moves_its_timestamp():
+    assert "IF(inbound_at >= NOW(), inbound_at + INTERVAL 1 SECOND, NOW())" in cycle_states.timestamp_sql("reweigh_inbound")
+    assert cycle_states.timestamp_sql("inbound") == "inbound_at = NOW()"
+    assert not cycle_states.enters_new_state("reweigh_inbound")
+    assert cycle_states.enters_new_state("inbound")
+
+
+def test_record_inbound_many_sql():
+    sql = cycle_states.record_inbound_many_sql("inbound", 2)
+    assert sql.count("WHEN %s THEN %s") == 2
+    assert sql.endswith("WHERE id IN (%s, %s) AND status IN ('picked')")
+
+
+def test_every_update_transition_is_registered(backend):
+    assert set(backend.SQL_CYCLE_TRANSITIONS) == set(cycle_states.transition_statements())
+    assert ("picked", False) not in backend.SQL_CYCLE_TRANSITIONS
+    assert ("inbound", True) in backend.SQL_CYCLE_TRANSITIONS
+    assert ("sorting", True) not in backend.SQL_CYCLE_TRANSITIONS
+
+
+class Cycle:
+    """answer() for one pickup_bag_cycle row and the turnaround table check"""
+
+    def __init__(self, status):
+        self.status = status
+
+    def __call__(self, sql, params, fetch):
+        if "information_schema" in sql:
+            return {"success": True, "data": {"n": 0}}  # No rollup table
+        if sql.startswith("UPDATE pickup_bag_cycle"):
+            allowed = sql.rsplit("status IN (", 1)[1]
+            changed = self.status is not None and f"'{self.status}'" in allowed
+            if changed:
+                self.status = sql.split("status = '", 1)[1].split("'", 1)[0]
+            return {"success": True, "data": {"rowcount": int(changed), "lastrowid": None}}
+        if sql.startswith("SELECT status"):
+            return {"success": True, "data": {"status": self.status} if self.status else None}
+        raise AssertionError(sql)
+
+
+@pytest.fixture
+def no_rollup_cache(backend):
+    backend._turnaround_table.reset()
+    yield
+    backend._turnaround_table.reset()
+
+
+def test_transition_taken_is_one_update(backend, no_rollup_cache):
+    cycle = Cycle("picked")
+    result, queries = drive_flow(backend, backend.transition_cycle_flow(7, "sorting"), cycle)
+    assert result == {"success": True, "data": "sorting"}
+    assert [sql.split()[0] for sql, _ in queries] == ["UPDATE", "SELECT"]  # The SELECT is the rollup check
+    assert queries[0][1] == (7,)
+
+
+def test_refused_transition_reports_current_status(backend, no_rollup_cache):
+    result, queries = drive_flow(backend, backend.transition_cycle_flow(7, "sorting"), Cycle("completed"))
+    assert result["success"] is False
+    assert result["current_status"] == "completed"
+    assert queries[-1][0].startswith("SELECT status")
+
+
+def test_missing_cycle_has_no_current_status(backend, no_rollup_cache):
+    result, _ = drive_flow(backend, backend.transition_cycle_flow(7, "completed"), Cycle(None))
+    assert (result["success"], result["current_status"], result["error"]) == (False, None, "Cycle not found")
+
+
+def test_reweigh_is_not_rolled_up(backend, no_rollup_cache):
+    result, queries = drive_flow(backend, backend.transition_cycle_flow(7, "reweigh_inbound", 3.5), Cycle("inbound"))
+    assert result == {"success": True, "data": "inbound"}
+    assert len(queries) == 1
+    assert queries[0][1] == (3.5, 7)
+
+
+def test_weigh_inbound_falls_back_when_the_cycle_moved_on(backend, no_rollup_cache):
+    # Read as picked, but another scanner weighed it first: the re-weigh still applies
+    result, queries = drive_flow(backend, backend.weigh_inbound_flow(7, 2.0, "picked"), Cycle("inbound"))
+    assert result == {"success": True, "data": "inbound"}
+    updates = [sql for sql, _ in queries if sql.startswith("UPDATE")]
+    assert len(updates) == 2 and "IF(inbound_at" in updates[1]
+
+
+def test_weigh_inbound_stops_once_sorted(backend, no_rollup_cache):
+    result, queries = drive_flow(backend, backend.weigh_inbound_flow(7, 2.0, "picked"), Cycle("sorting"))
+    assert result["current_status"] == "sorting"
+    assert len([sql for sql, _ in queries if sql.startswith("UPDATE")]) == 1
@@ -0,0 +1,79 @@
+"""IdempotencyStore: replay, expiry, the key bound and retries that wait for the original."""
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def store(backend):
+    return backend.IdempotencyStore()
+
+
+def test_replay_after_finish(store):
+    action, record = store.begin("/p", "k", b"{}")
+    assert action == "run"
+    store.finish(record, 200, "application/json", b"ok")
+    assert store.begin("/p", "k", b"{}") == ("replay", (200, "application/json", b"ok"))
+    assert store.begin("/p", "k", b"{ }") == ("mismatch", None)
+    assert store.begin("/other", "k", b"{}")[0] == "run"  # Keys are per path
+
+
+def test_server_errors_are_not_recorded(store):
+    _, record = store.begin("/p", "k", b"")
+    store.finish(record, 503, "application/json", b"down")
+    assert store.begin("/p", "k", b"")[0] == "run"
+
+
+def test_records_expire_after_ttl(backend, store, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(backend.time, "monotonic", lambda: clock[0])
+    monkeypatch.setitem(backend.app.config, "IDEMPOTENCY_TTL_SECONDS", 60)
+    _, record = store.begin("/p", "k", b"")
+    store.finish(record, 200, "application/json", b"ok")
+    clock[0] += 59
+    assert store.begin("/p", "k", b"")[0] == "replay"
+    clock[0] += 2
+    assert store.begin("/p", "k", b"")[0] == "run"
+
+
+def test_oldest_key_evicted_past_the_bound(backend, store, monkeypatch):
+    monkeypatch.setitem(backend.app.config, "IDEMPOTENCY_MAX_KEYS", 2)
+    for key in ("a", "b", "c"):
+        store.finish(store.begin("/p", key, b"")[1], 200, "application/json", key.encode())
+    assert store.stats()["keys"] == 2
+    assert store.begin("/p", "a", b"")[0] == "run"
+    assert store.begin("/p", "c", b"")[0] == "replay"
+
+
+def test_retry_waits_for_the_original(store):
+    _, record = store.begin("/p", "k", b"")
+    action, done = store.begin("/p", "k", b"")
+    assert action == "wait" and not done.is_set()
+    finisher = threading.Timer(0.05, store.finish, (record, 201, "application/json", b"made"))
+    finisher.start()
+    assert done.wait(2)
+    assert store.begin("/p", "k", b"") == ("replay", (201, "application/json", b"made"))
+
+
+def test_decorator_replays_and_gives_up_waiting(backend, monkeypatch):
+    monkeypatch.setattr(backend, "idempotency_store", backend.IdempotencyStore())
+    monkeypatch.setitem(backend.app.config, "IDEMPOTENCY_WAIT_SECONDS", 0)
+    calls = []
+
+    @backend.idempotent
+    def handler():
+        calls.append(1)
+        return backend.jsonify({"n": len(calls)}), 201
+
+    headers = {"Idempotency-Key": "k1"}
+    with backend.app.test_request_context("/p", method="POST", headers=headers, data=b"x"):
+        first = handler()
+    with backend.app.test_request_context("/p", method="POST", headers=headers, data=b"x"):
+        second = handler()
+    assert len(calls) == 1
+    assert (second.status_code, second.get_data(), second.headers["Idempotent-Replayed"]) == (201, first.get_data(), "true")
+
+    backend.idempotency_store.begin("/p", "k2", b"x")  # Still running elsewhere
+    with backend.app.test_request_context("/p", method="POST", headers={"Idempotency-Key": "k2"}, data=b"x"):
+        response, status = handler()
+    assert status == 409 and len(calls) == 1
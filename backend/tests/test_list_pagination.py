@@ -0,0 +1,45 @@
+"""Keyset list pages: cursor tokens, page queries and cached totals."""
+from datetime import datetime
+
+import pytest
+
+
+def test_cursor_round_trip(backend):
+    token = backend.encode_page_cursor({"id": 42, "created_at": datetime(2026, 10, 1, 8, 30, 5)})
+    assert "=" not in token
+    assert backend.decode_page_cursor(token) == (datetime(2026, 10, 1, 8, 30, 5), 42)
+    assert backend.encode_page_cursor({"id": 42, "created_at": None}) is None
+
+
+@pytest.mark.parametrize("token", ["", "not-a-cursor", "WzEsMl0", "WyJ4IiwxXQ"])  # [1,2], ["x",1]
+def test_bad_cursor_is_a_value_error(backend, token):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        backend.decode_page_cursor(token)
+
+
+def test_pages_continue_after_the_last_row(backend, fake_db, monkeypatch):
+    monkeypatch.setattr(backend, "_list_totals", backend.OrderedDict())
+    rows = [{"id": row_id, "created_at": datetime(2026, 10, 1, 0, 0, row_id)} for row_id in range(9, 0, -1)]
+
+    def responder(sql, params):
+        if sql.startswith("SELECT COUNT(*)"):
+            return {"rows": [{"total": len(rows)}]}
+        if "created_at <" in sql:
+            _, created_at, row_id, limit = params[-4:]
+            after = [row for row in rows if (row["created_at"], row["id"]) < (created_at, row_id)]
+            return {"rows": after[:limit]}
+        if sql.startswith("SELECT id"):
+            return {"rows": rows[:params[-1]]}
+        return None
+
+    fake_db.responder = responder
+    columns = backend.BARCODE_LIST_COLUMNS
+    with backend.app.test_request_context():
+        first = backend.fetch_list_page("barcode_master_table", columns, [("is_active", 1)], 4)
+        second = backend.fetch_list_page("barcode_master_table", columns, [("is_active", 1)], 4,
+                                         cursor=first["pagination"]["next_cursor"])
+    assert [row["id"] for row in first["data"]] == [9, 8, 7, 6]
+    assert [row["id"] for row in second["data"]] == [5, 4, 3, 2]
+    assert second["pagination"]["has_more"] and second["pagination"]["total"] == 9
+    assert "OFFSET" not in fake_db.statements("SELECT id")[1]
+    assert len(fake_db.statements("SELECT COUNT(*)")) == 1  # Cached for the second page
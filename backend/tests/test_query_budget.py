@@ -0,0 +1,106 @@
+"""Per-endpoint query budgets (query_budget) and their enforcement under app.testing."""
+import io
+
+import pytest
+
+from conftest import PREFIX
+
+
+def queries_issued(backend, call):
+    """Run call() in a request context; returns (its result, statements it recorded)"""
+    with backend.app.test_request_context():
+        result = call()
+        return result, backend.get_request_queries()
+
+
+def test_get_cycle_details_is_one_query(backend, client, fake_db):
+    fake_db.responder = lambda sql, params: (
+        {"rows": [{"id": 7, "barcode_id": "BC7", "status": "picked", "barcode_info_id": None}]}
+        if sql.startswith("SELECT") else None
+    )
+    response = client.get(f"{PREFIX}/barcode/cycle/7")
+    assert response.status_code == 200
+    assert backend.get_cycle_details.query_budget == 1
+    assert len(fake_db.statements("SELECT")) == 1
+
+
+@pytest.mark.parametrize("status", ["completed", "in_progress"])
+def test_update_stop_status_is_three_queries(backend, fake_db, status):
+    fake_db.responder = lambda sql, params: (
+        {"rows": [{"branch_code": "BR1", "route_date": "2026-10-01"}]} if sql.startswith("SELECT") else None
+    )
+    result, queries = queries_issued(backend, lambda: backend.update_stop_status(11, status, weight=4.5))
+    assert result["success"]
+    assert len(queries) == 3  # stop UPDATE, stop info SELECT, pickup frequency UPDATE
+
+
+def test_budget_raises_only_in_tests(backend, monkeypatch):
+    @backend.query_budget(1)
+    def two_queries():
+        backend.g.db_queries += [None, None]
+
+    with backend.app.test_request_context():
+        backend.g.db_queries = []
+        monkeypatch.setattr(backend.app, "testing", True)
+        with pytest.raises(backend.QueryBudgetExceeded):
+            two_queries()
+        monkeypatch.setattr(backend.app, "testing", False)
+        two_queries()  # logged only
+
+
+def test_scan_batch_budget_is_per_chunk(backend, client, fake_db, monkeypatch):
+    monkeypatch.setitem(backend.app.config, "BARCODE_SCAN_BATCH_CHUNK", 2)
+    known = {}
+
+    def responder(sql, params):
+        if sql.startswith("INSERT"):
+            for barcode_id in params[::2]:
+                known[barcode_id] = {"id": len(known) + 1, "barcode_id": barcode_id, "is_active": 1}
+            return {"rowcount": len(params) // 2}
+        if sql.startswith("SELECT"):
+            return {"rows": [known[barcode_id] for barcode_id in params if barcode_id in known]}
+        return None
+
+    fake_db.responder = responder
+    response = client.post(f"{PREFIX}/barcode/scan/batch", json={"barcode_ids": [f"NEW{i}" for i in range(5)]})
+    assert response.status_code == 200
+    assert response.get_json()["data"]["summary"]["registered"] == 5
+    assert backend.scan_barcode_batch.query_budget_per_chunk
+    # 3 chunks of lookup + insert + re-read
+    assert len(fake_db.statements()) == 9
+
+
+def test_import_budget_is_per_chunk(backend, client, fake_db, monkeypatch):
+    monkeypatch.setitem(backend.app.config, "BARCODE_IMPORT_CHUNK", 2)
+    existing = {
+        "ON1": {"id": 1, "barcode_id": "ON1", "is_active": 1},
+        "OFF1": {"id": 2, "barcode_id": "OFF1", "is_active": 0},
+    }
+    fake_db.responder = lambda sql, params: (
+        {"rows": [existing[barcode_id] for barcode_id in params if barcode_id in existing]}
+        if sql.startswith("SELECT") else None
+    )
+    csv_body = "barcode_id,is_active\nON1,0\nOFF1,1\nNEW1,1\nNEW2,0\nNEW3,1\n"
+    response = client.post(
+        f"{PREFIX}/barcode/master/import",
+        data={"file": (io.BytesIO(csv_body.encode()), "barcodes.csv")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    summary = response.get_json()["data"]
+    assert (summary["inserted"], summary["activated"], summary["deactivated"]) == (3, 1, 1)
+    assert backend.import_barcode_master.query_budget == 4
+    assert len(fake_db.statements()) <= 4 * 3
+
+
+@pytest.mark.mysql
+def test_cycle_details_budget_on_mysql(backend, mysql_app):
+    """Same budget against a real server (TEST_MYSQL_DB with the app's tables)"""
+    client = mysql_app.test_client()
+    with mysql_app.app_context():
+        present = backend.execute_query(backend.SQL_TABLE_EXISTS, ("pickup_bag_cycle",), fetch_one=True)
+    if not (present.get("data") or {}).get("n"):
+        pytest.skip("pickup_bag_cycle does not exist in TEST_MYSQL_DB")
+    response = client.get(f"{PREFIX}/barcode/cycle/0")
+    assert response.status_code == 404
+    assert '"1 queries"' in response.headers["Server-Timing"]
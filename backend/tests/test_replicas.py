@@ -0,0 +1,109 @@
+"""Read/write splitting: stale-tolerant reads on a replica, everything after a write on the primary."""
+import mysql.connector
+import pytest
+
+from conftest import _mysql_settings
+from fakes import FakeServer
+
+
+def served_by(backend):
+    """Pool of the last statement the current request ran"""
+    return backend.g.db_queries[-1].pool
+
+
+@pytest.fixture
+def two_servers(backend, monkeypatch):
+    """Fake primary and replica, told apart by the host the pool connects to"""
+    servers = {"primary-host": FakeServer(), "replica-host": FakeServer()}
+    monkeypatch.setattr(backend.mysql.connector, "connect", lambda **kwargs: servers[kwargs["host"]].connect())
+    monkeypatch.setitem(backend.app.config, "MYSQL_HOST", "primary-host")
+    monkeypatch.setitem(backend.app.config, "MYSQL_REPLICA_HOSTS", [("replica-host", 3306)])
+    monkeypatch.setattr(backend, "_replica_state", {})
+    backend._reset_db_pools_after_fork()
+    yield servers
+    backend._reset_db_pools_after_fork()
+
+
+def test_stale_reads_go_to_the_replica_until_a_write(backend, two_servers):
+    with backend.app.test_request_context():
+        backend.execute_query("SELECT 1", max_staleness=5)
+        assert served_by(backend).startswith("replica")
+        backend.execute_query("SELECT 1")
+        assert served_by(backend) == "primary"
+        backend.execute_query("UPDATE t SET n = 1")
+        backend.execute_query("SELECT 1", max_staleness=5)
+        assert served_by(backend) == "primary"  # Reads its own write
+    assert two_servers["replica-host"].statements("SELECT") == ["SELECT 1"]
+
+
+def test_lagging_replica_is_skipped(backend, two_servers):
+    two_servers["replica-host"].responder = lambda sql, params: (
+        {"rows": [{"Seconds_Behind_Source": 12}]} if sql.startswith("SHOW") else None
+    )
+    with backend.app.test_request_context():
+        backend.execute_query("SELECT 1", max_staleness=5)
+        assert served_by(backend) == "primary"
+        backend.execute_query("SELECT 1", max_staleness=30)
+        assert served_by(backend).startswith("replica")
+
+
+@pytest.mark.parametrize("error", [
+    mysql.connector.errors.DatabaseError(msg="Query execution was interrupted", errno=3024),
+    mysql.connector.errors.ProgrammingError(msg="Unknown column 'x'", errno=1054),
+])
+def test_statement_errors_on_the_replica_are_not_retried(backend, two_servers, error):
+    two_servers["replica-host"].responder = lambda sql, params: error if sql.startswith("SELECT") else None
+    with backend.app.test_request_context():
+        result = backend.execute_query("SELECT x FROM t", fetch_all=True, max_staleness=5)
+    assert not result["success"]
+    assert two_servers["primary-host"].statements("SELECT") == []
+    assert not backend.get_replica_status()["replica:0"]["down"]
+
+
+def test_lost_replica_retries_on_the_primary(backend, two_servers):
+    two_servers["replica-host"].responder = lambda sql, params: (
+        mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013) if sql.startswith("SELECT") else None
+    )
+    two_servers["primary-host"].responder = lambda sql, params: {"rows": [{"n": 1}]} if sql.startswith("SELECT") else None
+    with backend.app.test_request_context():
+        result = backend.execute_query("SELECT 1 AS n", fetch_one=True, max_staleness=5)
+        assert result == {"success": True, "data": {"n": 1}}
+    assert two_servers["primary-host"].statements("SELECT") == ["SELECT 1 AS n"]
+    assert backend.get_replica_status()["replica:0"]["down"]
+
+
+@pytest.mark.mysql
+def test_replica_routing_on_mysql(backend, monkeypatch):
+    """Against TEST_MYSQL_HOST and TEST_MYSQL_REPLICA_HOST (a real replica or any second server)"""
+    primary = _mysql_settings("TEST_MYSQL_HOST")
+    replica = _mysql_settings("TEST_MYSQL_REPLICA_HOST")
+    uuids = {}
+    for name, settings in (("primary", primary), ("replica", replica)):
+        connection = mysql.connector.connect(
+            host=settings["MYSQL_HOST"], port=settings["MYSQL_PORT"], user=settings["MYSQL_USER"],
+            password=settings["MYSQL_PASSWORD"], database=settings["MYSQL_DB"],
+        )
+        cursor = connection.cursor()
+        cursor.execute("SELECT @@server_uuid")
+        uuids[name] = cursor.fetchone()[0]
+        connection.close()
+    if uuids["primary"] == uuids["replica"]:
+        pytest.skip("TEST_MYSQL_REPLICA_HOST is the same server as TEST_MYSQL_HOST")
+
+    for key, value in primary.items():
+        monkeypatch.setitem(backend.app.config, key, value)
+    monkeypatch.setitem(backend.app.config, "MYSQL_REPLICA_HOSTS", [(replica["MYSQL_HOST"], replica["MYSQL_PORT"])])
+    monkeypatch.setattr(backend, "_replica_state", {})
+    backend._reset_db_pools_after_fork()
+    try:
+        with backend.app.test_request_context():
+            def server_uuid(**kwargs):
+                return backend.execute_query("SELECT @@server_uuid AS id", fetch_one=True, **kwargs)["data"]["id"]
+
+            assert server_uuid(max_staleness=3600) == uuids["replica"]
+            assert server_uuid() == uuids["primary"]
+            backend.execute_query("CREATE TEMPORARY TABLE replica_routing_probe (n INT)")
+            backend.execute_query("DELETE FROM replica_routing_probe")
+            assert server_uuid(max_staleness=3600) == uuids["primary"]
+    finally:
+        backend._reset_db_pools_after_fork()
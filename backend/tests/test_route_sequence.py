@@ -0,0 +1,33 @@
+"""allocate_stop_sequence_flow with and without migration 5's counter table."""
+from fakes import drive_flow
+
+
+def allocate(backend, table_present):
+    def answer(sql, params, fetch):
+        if "information_schema" in sql:
+            return {"success": True, "data": {"n": int(table_present)}}
+        if sql.startswith("INSERT INTO b2b_route_stop_sequences"):
+            return {"success": True, "data": {"lastrowid": 8, "rowcount": 2}}
+        return {"success": True, "data": {"next_sequence": 5}}
+
+    backend._route_sequence_table.reset()
+    return drive_flow(backend, backend.allocate_stop_sequence_flow(3), answer)
+
+
+def test_counter_table(backend):
+    result, queries = allocate(backend, True)
+    assert result == {"success": True, "data": 8}
+    assert queries[-1][0].startswith("INSERT INTO b2b_route_stop_sequences")
+
+
+def test_fallback_until_migrated_then_counter(backend):
+    result, queries = allocate(backend, False)
+    assert result == {"success": True, "data": 5}
+    assert "MAX(sequence)" in queries[-1][0]
+    # A missing table is not remembered forever
+    backend._route_sequence_table.expires_at = 0.0
+    _, queries = drive_flow(
+        backend, backend.allocate_stop_sequence_flow(3),
+        lambda sql, params, fetch: {"success": True, "data": {"n": 1, "lastrowid": 9, "rowcount": 1}},
+    )
+    assert queries[-1][0].startswith("INSERT INTO b2b_route_stop_sequences")
@@ -0,0 +1,50 @@
+"""SchemaCheck: cached presence of migration-created tables."""
+from fakes import drive_flow
+
+
+def make_check(backend):
+    check = backend.SchemaCheck(backend.SQL_TABLE_EXISTS, ("some_table",), "some_table missing", backend.db_logger)
+    backend.SchemaCheck._instances.remove(check)
+    return check
+
+
+def test_missing_is_rechecked_after_its_ttl(backend, monkeypatch):
+    check = make_check(backend)
+    clock = [1000.0]
+    monkeypatch.setattr(backend.time, "monotonic", lambda: clock[0])
+    monkeypatch.setitem(backend.app.config, "SCHEMA_CHECK_MISSING_TTL", 30)
+    count = [0]
+
+    present, queries = drive_flow(backend, check.flow(), lambda sql, params, fetch: {"success": True, "data": {"n": count[0]}})
+    assert (present, len(queries)) == (False, 1)
+    present, queries = drive_flow(backend, check.flow(), lambda *_: None)
+    assert (present, queries) == (False, [])  # Cached
+
+    count[0] = 1
+    clock[0] += 31
+    present, queries = drive_flow(backend, check.flow(), lambda sql, params, fetch: {"success": True, "data": {"n": count[0]}})
+    assert (present, len(queries)) == (True, 1)
+
+
+def test_failed_check_caches_nothing(backend):
+    check = make_check(backend)
+    present, _ = drive_flow(backend, check.flow(), lambda *_: {"success": False, "error": "down"})
+    assert present is False and check.present is None
+
+
+def test_reset_all_forgets_answers(backend):
+    check = make_check(backend)
+    backend.SchemaCheck._instances.append(check)
+    try:
+        drive_flow(backend, check.flow(), lambda *_: {"success": True, "data": {"n": 1}})
+        backend.SchemaCheck.reset_all()
+        _, queries = drive_flow(backend, check.flow(), lambda *_: {"success": True, "data": {"n": 1}})
+        assert len(queries) == 1
+    finally:
+        backend.SchemaCheck._instances.remove(check)
+
+
+def test_fold_sql_does_not_use_values(backend):
+    for to_status in backend.SQL_TURNAROUND_FOLDS:
+        assert "VALUES(" not in backend._turnaround_fold_sql(to_status, 3)
+    assert "VALUES(" not in backend.SQL_TURNAROUND_BACKFILL.sql
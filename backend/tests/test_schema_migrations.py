@@ -0,0 +1,95 @@
+"""schema_migrations.apply_migrations against a scripted schema."""
+import schema_migrations
+from fakes import FakeServer
+from schema_migrations import IndexSpec, Migration
+
+
+class Schema:
+    """responder() for information_schema and schema_migrations lookups; records the DDL it is sent"""
+
+    def __init__(self, tables, applied=None):
+        self.tables = tables  # table -> {index name: (unique, [columns])}
+        self.applied = applied
+        self.ddl = []
+
+    def __call__(self, sql, params):
+        if sql.startswith("SELECT COUNT(*) AS n FROM information_schema.TABLES"):
+            if sql.endswith("'schema_migrations'"):
+                return {"rows": [{"n": int(self.applied is not None)}]}
+            return {"rows": [{"n": int(params[0] in self.tables)}]}
+        if "information_schema.STATISTICS" in sql:
+            return {"rows": [
+                {"index_name": name, "non_unique": int(not unique), "column_name": column}
+                for name, (unique, columns) in self.tables[params[0]].items() for column in columns
+            ]}
+        if sql == "SELECT version FROM schema_migrations":
+            return {"rows": [{"version": version} for version in self.applied]}
+        if sql.startswith("EXPLAIN"):
+            return {"rows": [{"table": "t", "type": "ref", "key": None, "rows": 1, "Extra": None}]}
+        if sql.startswith("CREATE TABLE schema_migrations"):
+            self.applied = set()
+        elif sql.startswith("INSERT INTO schema_migrations"):
+            self.applied.add(params[0])
+        else:
+            self.ddl.append(sql)
+        return None
+
+
+def run(schema, migrations, dry_run):
+    server = FakeServer()
+    server.responder = schema
+    echoed = []
+    ok = schema_migrations.apply_migrations(server.connect().cursor(), migrations, dry_run=dry_run, echo=echoed.append)
+    return ok, echoed
+
+
+MIGRATIONS = [
+    Migration(1, "indexes", indexes=(IndexSpec("t", "idx_t_a_b", ("a", "b"), "SELECT 1 FROM t WHERE a = %s", (0,)),),
+              statements=()),
+    Migration(2, "table", indexes=(), statements=("CREATE TABLE IF NOT EXISTS u (id INT)",)),
+]
+
+
+def test_index_satisfying_reuses_prefixes_and_unique_keys():
+    indexes = {"PRIMARY": (True, ["id"]), "idx_ab": (False, ["a", "b", "c"])}
+    assert schema_migrations.index_satisfying(indexes, ("a", "b")) == "idx_ab"
+    assert schema_migrations.index_satisfying(indexes, ("id", "status")) == "PRIMARY"
+    assert schema_migrations.index_satisfying(indexes, ("b",)) is None
+
+
+def test_dry_run_changes_nothing():
+    schema = Schema({"t": {"PRIMARY": (True, ["id"])}})
+    ok, echoed = run(schema, MIGRATIONS, dry_run=True)
+    assert ok
+    assert schema.ddl == [] and schema.applied is None
+    assert any(line.startswith("  would run: ALTER TABLE t ADD INDEX idx_t_a_b (a, b)") for line in echoed)
+
+
+def test_apply_adds_missing_and_records_versions():
+    schema = Schema({"t": {"PRIMARY": (True, ["id"])}})
+    ok, _ = run(schema, MIGRATIONS, dry_run=False)
+    assert ok
+    assert schema.ddl == [
+        "ALTER TABLE t ADD INDEX idx_t_a_b (a, b), ALGORITHM=INPLACE, LOCK=NONE",
+        "CREATE TABLE IF NOT EXISTS u (id INT)",
+    ]
+    assert schema.applied == {1, 2}
+
+
+def test_applied_versions_only_reverify_indexes():
+    schema = Schema({"t": {"idx_other": (False, ["a", "b"])}}, applied={1, 2})
+    ok, echoed = run(schema, MIGRATIONS, dry_run=False)
+    assert ok and schema.ddl == []
+    assert "  ok t(a, b) served by idx_other" in echoed
+
+
+def test_conflicting_index_name_is_left_unrecorded():
+    schema = Schema({"t": {"idx_t_a_b": (False, ["b"])}})
+    ok, _ = run(schema, MIGRATIONS, dry_run=False)
+    assert not ok
+    assert schema.applied == {2}
+
+
+def test_migrations_are_ordered(backend):
+    versions = [migration.version for migration in backend.SCHEMA_MIGRATIONS]
+    assert versions == sorted(set(versions))
@@ -0,0 +1,133 @@
+"""Offline journal: cursors, the server-side device position and stale weights."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from fakes import drive_flow
+
+RECEIVED = datetime(2026, 5, 1, 12, 0, 0)
+
+
+def test_cursor_round_trip(backend):
+    token = backend.encode_journal_cursor("dev-1", 41)
+    assert backend.decode_journal_cursor(token, "dev-1") == 41
+    with pytest.raises(ValueError):
+        backend.decode_journal_cursor(token, "dev-2")
+    with pytest.raises(ValueError):
+        backend.decode_journal_cursor("not a cursor", "dev-1")
+
+
+def test_client_time_is_server_local(backend):
+    aware = backend._journal_client_time("2026-05-01T10:00:00+00:00")
+    assert aware.tzinfo is None
+    assert aware == datetime.fromisoformat("2026-05-01T10:00:00+00:00").astimezone().replace(tzinfo=None)
+    assert backend._journal_client_time("2026-05-01T10:00:00") == datetime(2026, 5, 1, 10, 0, 0)
+
+
+class Journal:
+    """Answers for sync_journal_group_flow: the device row and one cycle"""
+
+    def __init__(self, last_seq=None, inbound_at=None, status="picked"):
+        self.last_seq = last_seq
+        self.cycle = {"id": 9, "cycle_id": "C9", "barcode_id": "B9", "branch_code": "BR", "route_id": None,
+                      "status": status, "inbound_at": inbound_at, "inbound_weight": None}
+        self.saved = []
+        self.weighed = []
+
+    def __call__(self, sql, params, fetch):
+        if "information_schema.TABLES" in sql:
+            return {"success": True, "data": {"n": 1}}
+        if sql.startswith("SELECT last_seq FROM sync_journal_devices"):
+            return {"success": True, "data": None if self.last_seq is None else {"last_seq": self.last_seq}}
+        if sql.startswith("INSERT INTO sync_journal_devices"):
+            self.saved.append(params)
+            return {"success": True, "data": 1}
+        if sql.startswith("UPDATE pickup_bag_cycle"):
+            self.weighed.append(params)
+            self.cycle.update(status="inbound", inbound_weight=params[0])
+            return {"success": True, "data": {"lastrowid": 0, "rowcount": 1}}
+        if "FROM pickup_bag_cycle" in sql:
+            return {"success": True, "data": dict(self.cycle)}
+        return {"success": True, "data": None}
+
+
+def weight_op(seq, weight, taken_at):
+    return seq, "inbound_weight", {"cycle_id": 9, "inbound_weight": weight}, taken_at
+
+
+def run_group(backend, journal, operations, ops=None):
+    backend._journal_device_table.reset()
+    (results, _), queries = drive_flow(
+        backend, backend.sync_journal_group_flow("dev-1", operations, RECEIVED), journal, ops
+    )
+    return results, queries
+
+
+def test_server_skips_what_it_already_settled(backend):
+    journal = Journal(last_seq=5)
+    taken = RECEIVED - timedelta(hours=1)
+    results, _ = run_group(backend, journal, [weight_op(4, 10.0, taken), weight_op(5, 11.0, taken), weight_op(6, 12.0, taken)])
+    assert [r["status"] for r in results] == ["skipped", "skipped", "applied"]
+    assert results[0]["resolution"] == "already_synced"
+    assert journal.weighed == [(12.0, 9)]
+    assert journal.saved == [("dev-1", 6)]
+
+
+def test_device_position_is_locked_and_saved_in_the_group(backend):
+    journal = Journal()
+    results, queries = run_group(backend, journal, [weight_op(1, 10.0, RECEIVED - timedelta(minutes=5))])
+    assert results[0]["status"] == "applied"
+    assert queries[1][0].endswith("FOR UPDATE")
+    assert queries[-1][0].startswith("INSERT INTO sync_journal_devices")
+
+
+def test_failed_position_save_rolls_the_group_back(backend):
+    journal = Journal()
+    fail_save = lambda sql, params, fetch: (
+        {"success": False, "error": "deadline"} if sql.startswith("INSERT INTO sync_journal_devices")
+        else journal(sql, params, fetch)
+    )
+    ops = []
+    run_group(backend, fail_save, [weight_op(1, 10.0, RECEIVED - timedelta(minutes=5))], ops)
+    assert any(isinstance(op, backend.DbRollbackOnly) for op in ops)
+
+
+def test_weight_taken_before_a_later_weighing_is_stale(backend):
+    weighed_online = RECEIVED - timedelta(minutes=10)
+    journal = Journal(inbound_at=weighed_online, status="inbound")
+    results, _ = run_group(backend, journal, [weight_op(1, 10.0, weighed_online - timedelta(minutes=1))])
+    assert (results[0]["status"], results[0]["resolution"]) == ("skipped", "stale_weight")
+    assert journal.weighed == []
+
+
+def test_weighings_since_the_flush_arrived_are_not_stale(backend):
+    # The journal's own first weighing set inbound_at after RECEIVED
+    journal = Journal(inbound_at=RECEIVED + timedelta(seconds=1), status="inbound")
+    results, _ = run_group(backend, journal, [weight_op(2, 10.5, RECEIVED - timedelta(minutes=1))])
+    assert results[0]["status"] == "applied"
+
+
+def test_flush_without_cursor_is_not_reapplied(backend, fake_db):
+    """End to end: the request sends no cursor, the server still skips"""
+    def responder(sql, params):
+        if "information_schema.TABLES" in sql:
+            return {"rows": [{"n": 1}]}
+        if sql.startswith("SELECT last_seq FROM sync_journal_devices"):
+            return {"rows": [{"last_seq": 2}]}
+        return None
+
+    fake_db.responder = responder
+    body = {
+        "device_id": "dev-1",
+        "operations": [
+            {"seq": 1, "type": "status_update", "client_ts": "2026-05-01T10:00:00", "data": {"cycle_id": 9, "status": "sorting"}},
+            {"seq": 2, "type": "status_update", "client_ts": "2026-05-01T10:01:00", "data": {"cycle_id": 9, "status": "completed"}},
+        ],
+    }
+    backend._journal_device_table.reset()
+    with backend.app.test_request_context():
+        response, status = backend.apply_sync_journal(body)
+    assert status == 200
+    assert [r["resolution"] for r in response["data"]["results"]] == ["already_synced", "already_synced"]
+    assert not fake_db.statements("UPDATE")
+    assert backend.decode_journal_cursor(response["data"]["cursor"], "dev-1") == 2
@@ -0,0 +1,52 @@
+"""Turnaround sketches: merging stored sketches and reading quantiles back out."""
+import math
+import random
+
+from fakes import drive_flow
+
+
+def sketch_of(backend, durations):
+    """The sketch the rollup SQL builds (see _sketch_bucket_sql)"""
+    sketch = {}
+    for seconds in durations:
+        bucket = 0 if seconds < 1 else math.ceil(math.log(seconds) / math.log(backend.TURNAROUND_SKETCH_GAMMA))
+        sketch[bucket] = sketch.get(bucket, 0) + 1
+    return sketch
+
+
+def test_quantiles_within_relative_error(backend):
+    rng = random.Random(7)
+    durations = sorted(rng.lognormvariate(8, 1.2) for _ in range(5000))
+    sketch = sketch_of(backend, durations)
+    gamma = backend.TURNAROUND_SKETCH_GAMMA
+    for q in backend.TURNAROUND_QUANTILES:
+        exact = durations[math.ceil(q * len(durations)) - 1]
+        assert abs(backend.sketch_quantile(sketch, q) - exact) / exact <= (gamma - 1) / (gamma + 1) + 1e-3
+
+
+def test_merge_matches_one_sketch_of_everything(backend):
+    first, second = [5, 60, 3600], [0.5, 60, 86400]
+    stored = [{str(bucket): count for bucket, count in sketch_of(backend, part).items()} for part in (first, second)]
+    assert backend.merge_sketches(stored) == sketch_of(backend, first + second)
+    assert backend.merge_sketches(backend._load_sketch(value) for value in (b'{"3": 2}', None, '{"3": 1}')) == {3: 3}
+
+
+def test_empty_and_sub_second(backend):
+    assert backend.sketch_quantile({}, 0.5) is None
+    assert backend.sketch_quantile({0: 4}, 0.99) == 0.0
+
+
+def test_fold_is_skipped_until_the_rollup_table_exists(backend):
+    backend._turnaround_table.reset()
+    try:
+        answer = lambda sql, params, fetch: {"success": True, "data": {"n": 0}}
+        _, queries = drive_flow(backend, backend.fold_turnaround_flow("inbound", (1, 2)), answer)
+        assert len(queries) == 1 and "information_schema" in queries[0][0]
+
+        backend._turnaround_table.reset()
+        answer = lambda sql, params, fetch: {"success": True, "data": {"n": 1, "rowcount": 2}}
+        _, queries = drive_flow(backend, backend.fold_turnaround_flow("inbound", (1, 2)), answer)
+        stages = len(backend._turnaround_stages_ending("inbound"))
+        assert queries[-1][1] == (1, 2) * stages
+    finally:
+        backend._turnaround_table.reset()
@@ -0,0 +1,43 @@
+"""Weight discrepancy statistics: per-group quantiles and robust scores."""
+import numpy as np
+
+
+def test_group_quantiles_match_numpy_per_group(backend):
+    rng = np.random.default_rng(3)
+    codes = rng.integers(0, 4, 500)
+    codes[codes == 2] = 1  # Group 2 stays empty
+    values = rng.normal(0, 5, 500)
+    quantiles = (0.05, 0.5, 0.95)
+    result = backend._group_quantiles(codes, values, 5, quantiles)
+    for group in (0, 1, 3):
+        assert np.allclose(result[:, group], np.quantile(values[codes == group], quantiles))
+    assert np.isnan(result[:, 2]).all() and np.isnan(result[:, 4]).all()
+
+
+def test_robust_scores_flag_only_the_outlier(backend):
+    codes = np.array([0, 0, 0, 0, 0, 1, 1, 1])
+    values = np.array([1.0, 2.0, 3.0, 2.0, 40.0, 10.0, 10.0, 10.0])
+    scores, medians, spreads = backend.robust_scores(codes, values, 2, min_spread=0.5)
+    assert medians.tolist() == [2.0, 10.0]
+    assert np.isclose(spreads[0], 1.4826)
+    assert spreads[1] == 0.5  # MAD 0, floored
+    assert np.argmax(np.abs(scores)) == 4
+    assert np.isclose(scores[4], 38 / 1.4826)
+    assert (scores[5:] == 0).all()
+
+
+def test_analysis_flags_large_deviations_only(backend):
+    columns = {
+        "id": np.arange(6),
+        "pickup_weight": np.array([10.0, 10.0, 10.0, 10.0, 10.0, 10.0]),
+        "inbound_weight": np.array([10.1, 9.9, 10.0, 10.2, 6.0, 9.95]),
+        "cycle_id": np.array([f"C{i}" for i in range(6)], dtype=object),
+        "barcode_id": np.array([f"B{i}" for i in range(6)], dtype=object),
+    }
+    labels = {}
+    for dimension, (column, _) in backend.WEIGHT_DISCREPANCY_GROUPS.items():
+        columns[column] = np.zeros(6, dtype=np.int64)
+        labels[dimension] = ["X", None]
+    report = backend.analyze_weight_discrepancies(columns, labels, threshold=3.5, min_kg=0.5, min_spread=0.5, max_flagged=10)
+    assert [cycle["cycle_id"] for cycle in report["flagged_cycles"]] == ["C4"]
+    assert report["summary"]["flagged"] == 1